@@ -1,10 +1,15 @@
 import streamlit as st
 import pandas as pd
+import os
+import time
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import lu_factor, lu_solve
 import plotly.express as px
 import plotly.graph_objects as go
 from google.cloud import bigquery
 from google.oauth2 import service_account
-from collections import defaultdict
 
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="Attribution Engine", layout="wide")
@@ -28,136 +33,192 @@ st.markdown("""
 # --- CONFIGURATION ---
 KEY_PATH = 'my_attribution_project/dbt-creds.json' 
 PROJECT_ID = 'marketing-attribution' # <--- UPDATE THIS TO YOUR ID
+CACHE_DIR = '.cache'
+SENTINELS = ['(start)', '(conversion)', '(null)']
+CACHE_TTL_MINUTES = 60 # Matches the materialized view refresh interval
 
 # --- CUSTOM MARKOV CLASS (Embedded for Portability) ---
 class RobustMarkovModel:
     def __init__(self, df):
-        self.df = df.copy()
-        self.transitions = defaultdict(int)
+        self.df = df # fit() sorts into a new frame, so the caller's df is never mutated
+        self.transitions = pd.Series(dtype='int64')
         self.conversion_rates = {}
         self.removal_effects = {}
         
     def fit(self):
         self.df = self.df.sort_values(['cookie', 'time'])
-        paths = self.df.groupby('cookie')['channel'].apply(list).reset_index()
+        self.conv_by_cookie = self.df.groupby('cookie')['conversion'].max()
+        self.total_revenue = float(self.df.loc[self.df['conversion'], 'conversion_value'].sum())
         
-        for path in paths['channel']:
-            unique_channels = ['(start)'] + path
-            user_id = paths[paths['channel'].apply(lambda x: x == path)]['cookie'].values[0]
-            has_converted = self.df[self.df['cookie'] == user_id]['conversion'].max()
-            
-            if has_converted:
-                unique_channels.append('(conversion)')
-            else:
-                unique_channels.append('(null)')
-                
-            for i in range(len(unique_channels)-1):
-                self.transitions[(unique_channels[i], unique_channels[i+1])] += 1
-                
-        # Calculate Probabilities
-        self.transition_probs = {}
-        outbound_counts = defaultdict(int)
-        for (from_node, _), count in self.transitions.items():
-            outbound_counts[from_node] += count
-            
-        for (from_node, to_node), count in self.transitions.items():
-            self.transition_probs[(from_node, to_node)] = count / outbound_counts[from_node]
+        # Pair each touch with the next one in its journey (NaN on the last touch)
+        self.df['next_channel'] = self.df.groupby('cookie')['channel'].shift(-1)
+        
+        # Sentinel edges: (start) -> first channel, last channel -> (conversion)/(null)
+        first = self.df.drop_duplicates('cookie', keep='first')
+        last = self.df.drop_duplicates('cookie', keep='last')
+        starts = pd.DataFrame({'channel': '(start)', 'next_channel': first['channel'].values})
+        ends = pd.DataFrame({'channel': last['channel'].values, 'next_channel': np.where(last['cookie'].map(self.conv_by_cookie), '(conversion)', '(null)')})
+        edges = pd.concat([starts, self.df[['channel', 'next_channel']], ends], ignore_index=True)
+        
+        # Count transitions (A -> B) and normalise by outbound volume, all as (from, to)-indexed Series
+        self.transitions = edges.groupby(['channel', 'next_channel']).size().rename_axis(['from', 'to'])
+        self.outbound_counts = self.transitions.groupby(level='from').sum()
+        self.transition_probs = self.transitions.div(self.outbound_counts, level='from')
+        
+        # Integer node ids (transient nodes first, absorbing last) and a CSR transition matrix
+        from_nodes = self.transition_probs.index.get_level_values('from')
+        to_nodes = self.transition_probs.index.get_level_values('to')
+        self.channels = pd.Index(sorted(from_nodes.unique())).append(pd.Index(['(conversion)', '(null)']))
+        self.start_idx = self.channels.get_loc('(start)')
+        self.conv_idx = self.channels.get_loc('(conversion)')
+        n = len(self.channels)
+        self.P = sp.csr_matrix((self.transition_probs.values, (self.channels.get_indexer(from_nodes), self.channels.get_indexer(to_nodes))), shape=(n, n))
+        
+        # Real channels (no sentinels) and their node ids, reused by every attribution run
+        self.channels_list = [c for c in self.channels if c not in SENTINELS]
+        self.channel_to_idx = {c: self.channels.get_loc(c) for c in self.channels_list}
         return self
 
     def calculate_attribution(self):
-        # Base Conversion
-        base_conversion = self._calculate_conversion_probability(self.transition_probs)
-        
-        # Removal Effects
-        all_channels = set([k[0] for k in self.transitions.keys() if k[0] not in ['(start)', '(null)', '(conversion)']])
-        results = {}
+        Q, r = self._absorbing_system()
         
-        for channel in all_channels:
-            temp_probs = self.transition_probs.copy()
-            for key in list(temp_probs.keys()):
-                if key[0] == channel: del temp_probs[key]
-                elif key[1] == channel: temp_probs[key] = 0
-            
-            new_conversion = self._calculate_conversion_probability(temp_probs)
-            results[channel] = 1 - (new_conversion / base_conversion) if base_conversion > 0 else 0
+        # Removal Effects for every channel from one factorization of (I - Q)
+        effects = self._removal_effects(self._fundamental_matrix(Q), r, self.start_idx)
+        results = {channel: effects[idx] for channel, idx in self.channel_to_idx.items()}
             
         # Allocate Revenue
         total_removal_effect = sum(results.values())
         attribution = {}
-        total_revenue = self.df[self.df['conversion'] == True]['conversion_value'].sum()
         
         for channel, effect in results.items():
             weight = effect / total_removal_effect if total_removal_effect > 0 else 0
-            attribution[channel] = weight * total_revenue
+            attribution[channel] = weight * self.total_revenue
             
         return pd.DataFrame(list(attribution.items()), columns=['Channel', 'Markov Value'])
 
-    def _calculate_conversion_probability(self, probs_dict):
-        memo = {}
-        def get_prob(node, visited):
-            if node == '(conversion)': return 1.0
-            if node == '(null)': return 0.0
-            if node in visited: return 0.0
-            if node in memo: return memo[node]
-            visited.add(node)
-            total_prob = 0
-            neighbors = [k[1] for k in probs_dict.keys() if k[0] == node]
-            for neighbor in neighbors:
-                p = probs_dict.get((node, neighbor), 0)
-                if p > 0: total_prob += p * get_prob(neighbor, visited.copy())
-            memo[node] = total_prob
-            return total_prob
-        return get_prob('(start)', set())
+    def _absorbing_system(self):
+        # Transient block of P: Q (transient -> transient) and r (transient -> (conversion))
+        n_transient = self.conv_idx
+        Q = self.P[:n_transient, :n_transient]
+        r = self.P[:n_transient, self.conv_idx].toarray().ravel()
+        return Q, r
+
+    def _fundamental_matrix(self, Q):
+        # N = (I - Q)^-1 from a single LU factorization
+        I = np.eye(Q.shape[0])
+        return lu_solve(lu_factor(I - Q.toarray()), I)
+
+    def _removal_effects(self, N, r, start):
+        # B = N r; a dead-end channel k is a rank-1 update of (I - Q), so by Sherman-Morrison
+        # its conversion is B[start] - N[start, k] * B[k] / N[k, k] -- all k in one expression
+        B = N @ r
+        base_conversion = B[start]
+        if base_conversion <= 0: return np.zeros(len(B))
+        new_conversion = base_conversion - N[start] * B / np.diag(N)
+        return 1 - new_conversion / base_conversion
 
 # --- DATA LOADER ---
+def cached_query(client, query, query_parameters=()):
+    # Local Parquet copy of a query result, keyed by the SQL text and its parameters, so repeat runs skip BigQuery
+    cache_key = query + repr([p.to_api_repr() for p in query_parameters])
+    pq_path = os.path.join(CACHE_DIR, f"{hashlib.sha256(cache_key.encode()).hexdigest()}.parquet")
+    if os.path.exists(pq_path) and time.time() - os.path.getmtime(pq_path) < CACHE_TTL_MINUTES * 60:
+        return pd.read_parquet(pq_path)
+    
+    job_config = bigquery.QueryJobConfig(query_parameters=list(query_parameters))
+    # Download through the BigQuery Storage Read API (parallel Arrow streams) instead of REST paging
+    df = client.query(query, job_config=job_config).to_dataframe(create_bqstorage_client=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    df.to_parquet(pq_path)
+    return df
+
+def get_client():
+    credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
+
 @st.cache_data
-def load_data():
+def load_data(selected_channels: tuple):
+    # The channel filter runs in BigQuery; st.cache_data keys on the tuple, so each selection caches separately
     try:
-        credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
-        client = bigquery.Client(credentials=credentials, project=credentials.project_id)
-        query = "SELECT * FROM `attribution_dev.fct_attributed_conversions` ORDER BY user_id, timestamp"
-        df = client.query(query).to_dataframe()
+        client = get_client()
+        query = "SELECT user_id, timestamp, source, interaction, conversion_value FROM `attribution_dev.mv_attributed_conversions` WHERE source IN UNNEST(@chans)"
+        df = cached_query(client, query, [bigquery.ArrayQueryParameter('chans', 'STRING', list(selected_channels))])
         
         # Preprocessing
         df = df.rename(columns={'user_id': 'cookie', 'timestamp': 'time', 'source': 'channel'})
         df['conversion'] = df['interaction'] == 'conversion'
         df['conversion_value'] = df['conversion_value'].fillna(0)
+        
+        # Compact dtypes: groupby/isin on channel hit small integer codes instead of Python strings
+        df['channel'] = df['channel'].astype('category')
+        df['cookie'] = df['cookie'].astype('int32')
         return df
     except Exception as e:
         st.error(f"Error loading data: {e}")
         return pd.DataFrame()
 
+@st.cache_data
+def load_last_click():
+    # Last-Click is a plain GROUP BY, so BigQuery aggregates it and returns one row per channel
+    try:
+        query = "SELECT channel, last_click_value FROM `attribution_dev.mv_last_click`"
+        lc_df = cached_query(get_client(), query)
+        lc_df.columns = ['Channel', 'Last Click Value']
+        lc_df['Last Click Value'] = lc_df['Last Click Value'].fillna(0)
+        return lc_df
+    except Exception as e:
+        st.error(f"Error loading last-click data: {e}")
+        return pd.DataFrame(columns=['Channel', 'Last Click Value'])
+
+@st.cache_data
+def get_unique_channels():
+    try:
+        query = "SELECT DISTINCT source FROM `attribution_dev.mv_attributed_conversions` ORDER BY source"
+        return cached_query(get_client(), query)['source'].tolist()
+    except Exception as e:
+        st.error(f"Error loading channels: {e}")
+        return []
+
+@st.cache_resource
+def build_model(sel_tuple):
+    # Fit once per channel selection; later reruns with the same selection reuse the model
+    model = RobustMarkovModel(load_data(sel_tuple))
+    model.fit()
+    return model, model.calculate_attribution()
+
 # --- MAIN APP UI ---
 def main():
     st.title("🚀 True-Value Attribution Engine")
     st.markdown("Comparing **Last-Click Bias** vs. **Algorithmic Reality** (Markov Chain)")
     
-    # 1. Load Data
+    # 1. Sidebar Filters
+    st.sidebar.header("Filter Settings")
+    all_channels = get_unique_channels()
+    selected_channels = st.sidebar.multiselect("Select Channels to Analyze", all_channels, default=all_channels)
+    
+    # 2. Load Data (filtered to the selected channels in BigQuery)
+    sel_tuple = tuple(sorted(selected_channels))
     with st.spinner('Querying BigQuery...'):
-        df = load_data()
+        df = load_data(sel_tuple)
         
     if df.empty:
         return
-
-    # 2. Sidebar Filters
-    st.sidebar.header("Filter Settings")
-    all_channels = df['channel'].unique()
-    selected_channels = st.sidebar.multiselect("Select Channels to Analyze", all_channels, default=all_channels)
-    
-    # Filter Logic
-    filtered_df = df[df['channel'].isin(selected_channels)]
     
-    # 3. Run Models Live
-    model = RobustMarkovModel(filtered_df)
-    model.fit()
-    markov_df = model.calculate_attribution()
+    # 3. Run Models (fitted once per channel selection)
+    model, markov_df = build_model(sel_tuple)
     
-    lc_df = filtered_df[filtered_df['conversion'] == True].groupby('channel')['conversion_value'].sum().reset_index()
-    lc_df.columns = ['Channel', 'Last Click Value']
+    lc_df = load_last_click()
+    lc_df = lc_df[lc_df['Channel'].isin(selected_channels)]
     
     # Merge
-    comparison = pd.merge(markov_df, lc_df, on='Channel', how='outer').fillna(0)
-    comparison['Lift'] = ((comparison['Markov Value'] - comparison['Last Click Value']) / comparison['Last Click Value']) * 100
+    comparison = markov_df.set_index('Channel').join(lc_df.set_index('Channel'), how='outer').fillna(0).reset_index()
+    
+    # Lift vs. Last Click; channels with no last-click revenue get 0 instead of inf
+    markov = comparison['Markov Value'].to_numpy()
+    last_click = comparison['Last Click Value'].to_numpy()
+    lift = np.zeros(len(comparison))
+    np.divide(markov - last_click, last_click, out=lift, where=last_click > 0)
+    comparison['Lift'] = lift * 100
     
     # 4. Top Level Metrics
     total_rev = comparison['Markov Value'].sum()
@@ -184,7 +245,7 @@ def main():
     with col_data:
         st.subheader("ROI Lift (Truth vs. Lie)")
         # Show which channels are being ignored
-        comparison['Status'] = comparison['Lift'].apply(lambda x: 'Undervalued 🟢' if x > 0 else 'Overvalued 🔴')
+        comparison['Status'] = np.where(markov > last_click, 'Undervalued 🟢', 'Overvalued 🔴')
         st.dataframe(comparison[['Channel', 'Lift', 'Status']].style.format({'Lift': "{:.1f}%"}), hide_index=True)
 
     # 6. Detailed Data Table
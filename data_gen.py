@@ -46,67 +46,79 @@ def generate_messy_data():
         current_date += timedelta(days=1)
         
     df_spend = pd.DataFrame(spend_data)
+    df_spend['date'] = pd.to_datetime(df_spend['date'])
+    df_spend['platform'] = df_spend['platform'].astype('category')
+    
+    # Parquet keeps the datetime/category dtypes; the CSV is what `dbt seed` loads
+    df_spend.to_parquet('ad_spend.parquet', compression='snappy', index=False)
     df_spend.to_csv('ad_spend.csv', index=False)
-    print(f"✅ Generated ad_spend.csv ({len(df_spend)} rows)")
+    print(f"✅ Generated ad_spend.parquet / ad_spend.csv ({len(df_spend)} rows)")
 
     # --- 2. Generate User Journey Data (Touchpoints) ---
-    user_data = []
+    # Every draw is made for all users / all touches at once instead of looping per touch
+    user_ids = np.arange(1, NUM_USERS + 1)
     
-    for user_id in range(1, NUM_USERS + 1):
-        # Determine how many touchpoints this user has (1 to 8)
-        num_touches = np.random.choice(range(1, 9), p=[0.3, 0.25, 0.2, 0.1, 0.05, 0.05, 0.03, 0.02])
-        
-        user_start_time = START_DATE + timedelta(days=random.randint(0, DAYS-5))
-        current_time = user_start_time
-        
-        has_converted = 0
-        conversion_value = 0
-        
-        # Journey Loop
-        for i in range(num_touches):
-            platform = random.choice(platforms)
-            source = platform
-            medium = 'cpc' if platform in ['Facebook', 'Google Ads'] else 'social'
-            
-            # Intentional messiness: Inconsistent UTM tagging
-            if random.random() < 0.05:
-                source = source.lower() # lowercase inconsistency
-            
-            user_data.append({
-                'user_id': user_id,
-                'timestamp': current_time,
-                'source': source,
-                'medium': medium,
-                'campaign': random.choice(campaigns[platform]) if platform in campaigns else 'unknown',
-                'interaction': 'click'
-            })
-            
-            # Time gap between touches (hours or days)
-            time_gap = timedelta(hours=random.randint(1, 48))
-            current_time += time_gap
-            
-        # Determine Conversion (Last touch)
-        # 15% conversion rate overall
-        if random.random() < 0.15:
-            has_converted = 1
-            conversion_value = random.uniform(50, 200)
-            
-            # Append the conversion event
-            user_data.append({
-                'user_id': user_id,
-                'timestamp': current_time + timedelta(minutes=5),
-                'source': 'direct', # Conversion usually happens on site
-                'medium': 'none',
-                'campaign': None,
-                'interaction': 'conversion',
-                'conversion_value': round(conversion_value, 2)
-            })
+    # Determine how many touchpoints each user has (1 to 8)
+    num_touches = np.random.choice(np.arange(1, 9), size=NUM_USERS, p=[0.3, 0.25, 0.2, 0.1, 0.05, 0.05, 0.03, 0.02])
+    total_touches = num_touches.sum()
+    touch_users = np.repeat(user_ids, num_touches)
+    first_touch = np.cumsum(num_touches) - num_touches # Row index of each user's first touch
+    
+    # Journey timing: a random start day per user, then a gap of 1-48 hours after every touch
+    user_start_time = np.datetime64(START_DATE) + np.random.randint(0, DAYS - 4, size=NUM_USERS).astype('timedelta64[D]')
+    time_gap = np.random.randint(1, 49, size=total_touches)
+    gaps_before = np.cumsum(time_gap) - time_gap # Hours elapsed before each touch...
+    gaps_before -= np.repeat(gaps_before[first_touch], num_touches) # ...within its own journey
+    touch_time = np.repeat(user_start_time, num_touches) + gaps_before.astype('timedelta64[h]')
+    
+    platform = np.random.choice(platforms, size=total_touches)
+    medium = np.where(np.isin(platform, ['Facebook', 'Google Ads']), 'cpc', 'social')
+    
+    # Intentional messiness: Inconsistent UTM tagging
+    source = np.where(np.random.random(total_touches) < 0.05, np.char.lower(platform), platform) # lowercase inconsistency
+    
+    campaign = np.full(total_touches, 'unknown', dtype=object)
+    for name, camp_list in campaigns.items():
+        is_platform = platform == name
+        campaign[is_platform] = np.random.choice(camp_list, size=is_platform.sum())
+    
+    df_touches = pd.DataFrame({
+        'user_id': touch_users,
+        'timestamp': touch_time,
+        'source': source,
+        'medium': medium,
+        'campaign': campaign,
+        'interaction': 'click'
+    })
+    
+    # Determine Conversion (Last touch)
+    # 15% conversion rate overall
+    has_converted = np.random.random(NUM_USERS) < 0.15
+    num_conversions = has_converted.sum()
+    journey_end = user_start_time + np.add.reduceat(time_gap, first_touch).astype('timedelta64[h]')
+    
+    # The conversion events
+    df_conversions = pd.DataFrame({
+        'user_id': user_ids[has_converted],
+        'timestamp': journey_end[has_converted] + np.timedelta64(5, 'm'),
+        'source': 'direct', # Conversion usually happens on site
+        'medium': 'none',
+        'campaign': None,
+        'interaction': 'conversion',
+        'conversion_value': np.round(np.random.uniform(50, 200, size=num_conversions), 2)
+    })
 
-    df_journey = pd.DataFrame(user_data)
+    # Each user's conversion follows their touches (stable sort keeps that order)
+    df_journey = pd.concat([df_touches, df_conversions], ignore_index=True)
+    df_journey = df_journey.sort_values('user_id', kind='stable', ignore_index=True)
+    
+    df_journey['timestamp'] = df_journey['timestamp'].astype('datetime64[ns]')
+    df_journey['source'] = df_journey['source'].astype('category')
     
-    # Save to CSV
+    # Save to Parquet (typed, compressed) and CSV (for `dbt seed`)
+    df_journey.to_parquet('user_journeys.parquet', compression='snappy', index=False)
     df_journey.to_csv('user_journeys.csv', index=False)
-    print(f"✅ Generated user_journeys.csv ({len(df_journey)} rows)")
+    print(f"✅ Generated user_journeys.parquet / user_journeys.csv ({len(df_journey)} rows)")
 
 if __name__ == "__main__":
     generate_messy_data()
\ No newline at end of file
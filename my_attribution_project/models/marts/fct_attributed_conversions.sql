@@ -1,3 +1,7 @@
+-- Materialized as a table so mv_attributed_conversions can be built on top of it
+-- (BigQuery materialized views cannot reference logical views)
+{{ config(materialized='table') }}
+
 with sessions as (
     select * from {{ ref('int_user_sessions') }}
 ),
@@ -0,0 +1,16 @@
+{{ config(
+    materialized='materialized_view',
+    enable_refresh=true,
+    refresh_interval_minutes=60
+) }}
+
+-- Slim, pre-computed copy of the attribution mart for the Python apps.
+-- Only the columns the models read are kept, so queries scan far less than select * on the mart.
+-- (BigQuery materialized views cannot carry an order by; the apps sort client-side.)
+select
+    user_id,
+    timestamp,
+    source,
+    interaction,
+    conversion_value
+from {{ ref('fct_attributed_conversions') }}
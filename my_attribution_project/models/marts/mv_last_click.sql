@@ -0,0 +1,14 @@
+{{ config(
+    materialized='materialized_view',
+    enable_refresh=true,
+    refresh_interval_minutes=60
+) }}
+
+-- Last-Click benchmark aggregated in the warehouse: one row per channel instead of every journey row.
+-- Last Click = the source of the conversion event.
+select
+    source as channel,
+    sum(conversion_value) as last_click_value
+from {{ ref('fct_attributed_conversions') }}
+where interaction = 'conversion'
+group by source
@@ -1,40 +1,67 @@
 import pandas as pd
+import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from google.cloud import bigquery
 from google.oauth2 import service_account
 import os
+import time
+import hashlib
 
 # --- CONFIGURATION ---
 # Update this to match your actual file location
 KEY_PATH = 'my_attribution_project\dbt-creds.json' 
 PROJECT_ID = 'marketing-engineering' # <--- UPDATE THIS with your Google Cloud Project ID
+CACHE_DIR = '.cache'
+CACHE_TTL_MINUTES = 60 # Matches the materialized view refresh interval
 
-def get_data():
+def cached_query(client, query):
+    # Keep a local Parquet copy of each query result, keyed by a hash of the SQL,
+    # so repeat runs within the TTL skip the BigQuery round-trip entirely
+    pq_path = os.path.join(CACHE_DIR, f"{hashlib.sha256(query.encode()).hexdigest()}.parquet")
+    
+    if os.path.exists(pq_path) and time.time() - os.path.getmtime(pq_path) < CACHE_TTL_MINUTES * 60:
+        print("♻️  Using cached query result")
+        return pd.read_parquet(pq_path)
+    
+    # Download through the BigQuery Storage Read API: columnar Arrow streams over gRPC,
+    # read in parallel, instead of paging JSON rows over REST
+    df = client.query(query).to_dataframe(create_bqstorage_client=True)
+    
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    df.to_parquet(pq_path)
+    return df
+
+def get_client():
     print("🔌 Connecting to BigQuery...")
     credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
-    client = bigquery.Client(credentials=credentials, project=credentials.project_id)
-    
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+def get_data(client):
+    # The materialized view holds only the columns we need (calculate_markov sorts itself)
     query = """
-    SELECT * FROM `attribution_dev.fct_attributed_conversions`
-    ORDER BY user_id, timestamp
+    SELECT user_id, timestamp, source, interaction, conversion_value
+    FROM `attribution_dev.mv_attributed_conversions`
     """
     
-    df = client.query(query).to_dataframe()
+    df = cached_query(client, query)
     print(f"✅ Data Loaded: {len(df)} rows")
     return df
 
-def calculate_last_click(df):
+def calculate_last_click(client):
     print("📊 Calculating Last Click Attribution...")
     # Last Click = The source of the conversion event
-    conversions = df[df['interaction'] == 'conversion']
+    # The aggregation runs in BigQuery (mv_last_click), so only one row per channel comes back
     
     # We attribute the value to the source of that conversion event
     # Note: In our data, the conversion event often has source='direct'. 
     # A true Last Click model looks at the LAST NON-DIRECT click. 
     # Let's simple filter for the conversion rows for this demo.
-    attribution = conversions.groupby('source')['conversion_value'].sum().reset_index()
-    attribution.columns = ['channel', 'last_click_value']
+    query = """
+    SELECT channel, last_click_value
+    FROM `attribution_dev.mv_last_click`
+    """
+    attribution = cached_query(client, query)
     
     # Normalize to percentages
     total_val = attribution['last_click_value'].sum()
@@ -48,41 +75,29 @@ def calculate_markov(df):
     # Sort by user and time
     df = df.sort_values(['user_id', 'timestamp'])
     
-    # Group into paths
-    paths = df.groupby('user_id')['source'].apply(list).reset_index()
+    # Work on the sorted touch table directly: each row's position in its path,
+    # the path length and the user's conversion value all come from one groupby
+    users = df.groupby('user_id')
+    pos = users.cumcount().to_numpy()
+    path_len = users['source'].transform('size').to_numpy()
+    
+    # Get the conversion value for each user
+    # We take the max because the conversion value is likely repeated on the conversion event rows
+    conv_value = users['conversion_value'].transform('max').to_numpy()
     
     # 2. Calculate Attribution (U-Shaped Proxy)
-    attribution = {}
-    
-    # FIXED LOGIC: Iterate through rows to get UserID and Path together
-    for index, row in paths.iterrows():
-        path = row['source']
-        user_id = row['user_id']
-        
-        # Get the conversion value for this specific user
-        # We take the max because the conversion value is likely repeated on the conversion event rows
-        conv_value = df[df['user_id'] == user_id]['conversion_value'].max()
-        
-        # Guard clause: If for some reason value is NaN/0, skip
-        if pd.isna(conv_value) or conv_value <= 0:
-            continue
-
-        if len(path) == 1:
-            attribution[path[0]] = attribution.get(path[0], 0) + conv_value
-        elif len(path) == 2:
-            attribution[path[0]] = attribution.get(path[0], 0) + (conv_value * 0.5)
-            attribution[path[1]] = attribution.get(path[1], 0) + (conv_value * 0.5)
-        else:
-            # First touch 40%
-            attribution[path[0]] = attribution.get(path[0], 0) + (conv_value * 0.4)
-            # Last touch 40%
-            attribution[path[-1]] = attribution.get(path[-1], 0) + (conv_value * 0.4)
-            # Middle touches share 20%
-            middle_share = (conv_value * 0.2) / (len(path) - 2)
-            for channel in path[1:-1]:
-                attribution[channel] = attribution.get(channel, 0) + middle_share
-
-    res = pd.DataFrame(list(attribution.items()), columns=['channel', 'multi_touch_value'])
+    # 1 touch: 100%. 2 touches: 50/50.
+    # Otherwise first and last touch get 40% each and the middle touches share 20%
+    weights = np.where(path_len == 1, 1.0,
+              np.where(path_len == 2, 0.5,
+              np.where((pos == 0) | (pos == path_len - 1), 0.4, 0.2 / np.maximum(path_len - 2, 1))))
+    
+    # Guard clause: If for some reason value is NaN/0, skip the user
+    converted = conv_value > 0
+    credit = pd.Series(weights[converted] * conv_value[converted], index=df['source'].to_numpy()[converted])
+    
+    res = credit.groupby(level=0).sum().reset_index()
+    res.columns = ['channel', 'multi_touch_value']
     total_val = res['multi_touch_value'].sum()
     res['multi_touch_pct'] = res['multi_touch_value'] / total_val
     
@@ -120,7 +135,8 @@ def visualize_results(last_click, multi_touch):
     plt.show()
 
 if __name__ == "__main__":
-    data = get_data()
-    lc = calculate_last_click(data)
+    client = get_client()
+    data = get_data(client)
+    lc = calculate_last_click(client)
     mt = calculate_markov(data) # Using Position-Based as our advanced proxy
     visualize_results(lc, mt)
\ No newline at end of file
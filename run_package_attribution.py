@@ -1,10 +1,15 @@
 import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import lu_factor, lu_solve
 import seaborn as sns
 import matplotlib.pyplot as plt
 from google.cloud import bigquery
 from google.oauth2 import service_account
-from collections import defaultdict
 import warnings
+import os
+import time
+import hashlib
 
 # Suppress warnings for cleaner output
 warnings.filterwarnings('ignore')
@@ -12,6 +17,9 @@ warnings.filterwarnings('ignore')
 # --- CONFIGURATION ---
 KEY_PATH = 'my_attribution_project\dbt-creds.json' 
 PROJECT_ID = 'marketing-engineering' # <--- UPDATE THIS
+CACHE_DIR = '.cache'
+SENTINELS = ['(start)', '(conversion)', '(null)'] # Path markers, not marketing channels
+CACHE_TTL_MINUTES = 60 # Matches the materialized view refresh interval
 
 # --- CUSTOM MARKOV ENGINE ---
 class RobustMarkovModel:
@@ -20,143 +28,157 @@ class RobustMarkovModel:
     Replaces broken off-the-shelf packages.
     """
     def __init__(self, df):
-        self.df = df.copy()
-        self.transitions = defaultdict(int)
+        # No defensive copy: fit() sorts into a new frame before adding columns,
+        # so the caller's DataFrame is never mutated
+        self.df = df
+        self.transitions = pd.Series(dtype='int64')
         self.conversion_rates = {}
         self.removal_effects = {}
         
     def fit(self):
         print("   ...Building Transition Matrix")
-        # 1. Sort and create paths
+        # 1. Sort into journeys
         self.df = self.df.sort_values(['cookie', 'time'])
-        paths = self.df.groupby('cookie')['channel'].apply(list).reset_index()
         
-        # 2. Count transitions (A -> B)
-        for path in paths['channel']:
-            # Add 'Start' node
-            unique_channels = ['(start)'] + path
-            
-            # Check if this user eventually converted
-            user_id = paths[paths['channel'].apply(lambda x: x == path)]['cookie'].values[0]
-            # Check the raw df for conversion flag
-            has_converted = self.df[self.df['cookie'] == user_id]['conversion'].max()
-            
-            if has_converted:
-                unique_channels.append('(conversion)')
-            else:
-                unique_channels.append('(null)')
-                
-            for i in range(len(unique_channels)-1):
-                from_node = unique_channels[i]
-                to_node = unique_channels[i+1]
-                self.transitions[(from_node, to_node)] += 1
-                
-        # 3. Calculate Probabilities
-        self.transition_probs = {}
-        outbound_counts = defaultdict(int)
+        # Conversion flag per user and total converted revenue, computed once here
+        # instead of filtering the raw df per path or per attribution run
+        self.conv_by_cookie = self.df.groupby('cookie')['conversion'].max()
+        self.total_revenue = float(self.df.loc[self.df['conversion'], 'conversion_value'].sum())
         
-        for (from_node, _), count in self.transitions.items():
-            outbound_counts[from_node] += count
-            
-        for (from_node, to_node), count in self.transitions.items():
-            probability = count / outbound_counts[from_node]
-            self.transition_probs[(from_node, to_node)] = probability
+        # 2. Pair every touch with the next one in the same journey
+        # (NaN on each journey's last touch, which groupby drops when counting)
+        self.df['next_channel'] = self.df.groupby('cookie')['channel'].shift(-1)
+        
+        # Add the sentinel edges straight from the sorted table:
+        # '(start)' -> first touch, and last touch -> '(conversion)'/'(null)'
+        first = self.df.drop_duplicates('cookie', keep='first')
+        last = self.df.drop_duplicates('cookie', keep='last')
+        starts = pd.DataFrame({'channel': '(start)', 'next_channel': first['channel'].values})
+        ends = pd.DataFrame({
+            'channel': last['channel'].values,
+            'next_channel': np.where(last['cookie'].map(self.conv_by_cookie), '(conversion)', '(null)')
+        })
+        edges = pd.concat([starts, self.df[['channel', 'next_channel']], ends], ignore_index=True)
+        
+        # 3. Count transitions (A -> B) and calculate probabilities
+        # Everything stays a (from, to)-indexed Series: outbound volume is one grouped
+        # sum over the edges, and dividing by it aligns on the 'from' level
+        self.transitions = edges.groupby(['channel', 'next_channel']).size().rename_axis(['from', 'to'])
+        self.outbound_counts = self.transitions.groupby(level='from').sum()
+        self.transition_probs = self.transitions.div(self.outbound_counts, level='from')
+        
+        # 4. Store the graph as integer node ids plus a CSR transition matrix.
+        # Transient nodes ('(start)' + channels) come first and the absorbing
+        # '(conversion)'/'(null)' nodes last, so the absorbing-chain blocks are plain slices.
+        from_nodes = self.transition_probs.index.get_level_values('from')
+        to_nodes = self.transition_probs.index.get_level_values('to')
+        
+        self.channels = pd.Index(sorted(from_nodes.unique())).append(pd.Index(['(conversion)', '(null)']))
+        self.start_idx = self.channels.get_loc('(start)')
+        self.conv_idx = self.channels.get_loc('(conversion)')
+        
+        from_idx = self.channels.get_indexer(from_nodes)
+        to_idx = self.channels.get_indexer(to_nodes)
+        n = len(self.channels)
+        self.P = sp.csr_matrix((self.transition_probs.values, (from_idx, to_idx)), shape=(n, n))
+        
+        # 5. Cache the real channels (no sentinels) and their node ids for attribution
+        self.channels_list = [c for c in self.channels if c not in SENTINELS]
+        self.channel_to_idx = {c: self.channels.get_loc(c) for c in self.channels_list}
             
         return self
 
     def calculate_attribution(self):
         print("   ...Calculating Removal Effects (This determines true value)")
         
-        # 1. Find all unique channels (excluding start/null/conversion)
-        all_channels = set([k[0] for k in self.transitions.keys() if k[0] not in ['(start)', '(null)', '(conversion)']])
+        # 1. Build the absorbing chain over the transient nodes ((start) + channels)
+        Q, r = self._absorbing_system()
         
-        # 2. Calculate Base Conversion Probability (Total System)
-        base_conversion = self._calculate_conversion_probability(self.transition_probs)
-        
-        # 3. Calculate Removal Effect for each channel
+        # 2. Calculate Removal Effect for each channel
         # "How much does conversion drop if we delete Facebook?"
-        results = {}
+        # Every channel comes out of a single factorization of (I - Q)
+        N = self._fundamental_matrix(Q)
+        effects = self._removal_effects(N, r, self.start_idx)
         
-        for channel in all_channels:
-            # Create a matrix where this channel acts as a 'dead end' (100% to null)
-            temp_probs = self.transition_probs.copy()
-            
-            # Redirect all traffic FROM this channel to (null)
-            # And remove any traffic GOING TO this channel (effectively skipping it)
-            # Simplified approach: Just make the channel loop to null.
-            for key in list(temp_probs.keys()):
-                if key[0] == channel:
-                    del temp_probs[key]
-                elif key[1] == channel:
-                    # Redirect incoming traffic to null? 
-                    # Simpler: Make the channel a sink.
-                    temp_probs[key] = 0 # Cut the link
-            
-            # Recalculate system conversion
-            new_conversion = self._calculate_conversion_probability(temp_probs)
-            
-            # Removal Effect = 1 - (New / Old)
-            if base_conversion > 0:
-                removal_effect = 1 - (new_conversion / base_conversion)
-            else:
-                removal_effect = 0
-                
-            results[channel] = removal_effect
+        # 3. Key the effects by channel name (channel ids were cached in fit())
+        results = {channel: effects[idx] for channel, idx in self.channel_to_idx.items()}
             
         # 4. Allocate Revenue based on Removal Effect weights
         total_removal_effect = sum(results.values())
         
         attribution = {}
-        total_revenue = self.df[self.df['conversion'] == True]['conversion_value'].sum()
         
         for channel, effect in results.items():
             weight = effect / total_removal_effect if total_removal_effect > 0 else 0
-            attribution[channel] = weight * total_revenue
+            attribution[channel] = weight * self.total_revenue
             
         return pd.DataFrame(list(attribution.items()), columns=['Channel', 'Markov Value'])
 
-    def _calculate_conversion_probability(self, probs_dict):
-        # A simple iterative path probability calculator
-        # In a full graph, this requires matrix inversion (I-Q)^-1
-        # For simplicity/robustness in a demo, we simulate flow or simple prob multiplication
-        # Let's use a Memoization approach to find prob from (start) to (conversion)
-        
-        memo = {}
-        
-        def get_prob(node, visited):
-            if node == '(conversion)': return 1.0
-            if node == '(null)': return 0.0
-            if node in visited: return 0.0 # prevent loops
-            if node in memo: return memo[node]
-            
-            visited.add(node)
-            total_prob = 0
-            
-            # Find all neighbors
-            neighbors = [k[1] for k in probs_dict.keys() if k[0] == node]
-            
-            for neighbor in neighbors:
-                p = probs_dict.get((node, neighbor), 0)
-                if p > 0:
-                    total_prob += p * get_prob(neighbor, visited.copy())
-            
-            memo[node] = total_prob
-            return total_prob
-            
-        return get_prob('(start)', set())
+    def _absorbing_system(self):
+        # Slice the absorbing-chain blocks out of P:
+        # Q (transient -> transient) and r (transient -> '(conversion)').
+        # Transient nodes occupy the ids before '(conversion)'.
+        n_transient = self.conv_idx
+        
+        Q = self.P[:n_transient, :n_transient]
+        r = self.P[:n_transient, self.conv_idx].toarray().ravel()
+                
+        return Q, r
+
+    def _fundamental_matrix(self, Q):
+        # N = (I - Q)^-1 via a single LU factorization of the (small, dense) system.
+        # Expected visits N[i, j] drive both the base conversion and every removal effect.
+        I = np.eye(Q.shape[0])
+        lu = lu_factor(I - Q.toarray())
+        return lu_solve(lu, I)
+
+    def _removal_effects(self, N, r, start):
+        # Removal Effect = 1 - (New / Old) for every transient node at once.
+        # B = N r holds every node's probability of ending in '(conversion)'.
+        # Making channel k a dead end (zeroing its row of Q and r) is a rank-1
+        # update of (I - Q). Sherman-Morrison reduces the re-solve to a lookup:
+        # N[start, k] / N[k, k] is the chance a journey ever reaches the channel,
+        # and B[k] is the conversion it would have gone on to deliver.
+        B = N @ r
+        base_conversion = B[start]
+        
+        if base_conversion <= 0:
+            return np.zeros(len(B))
+        
+        new_conversion = base_conversion - N[start] * B / np.diag(N)
+        return 1 - new_conversion / base_conversion
 
 # --- MAIN PIPELINE ---
-def get_data_and_format():
+def cached_query(client, query):
+    # Keep a local Parquet copy of each query result, keyed by a hash of the SQL,
+    # so repeat runs within the TTL skip the BigQuery round-trip entirely
+    pq_path = os.path.join(CACHE_DIR, f"{hashlib.sha256(query.encode()).hexdigest()}.parquet")
+    
+    if os.path.exists(pq_path) and time.time() - os.path.getmtime(pq_path) < CACHE_TTL_MINUTES * 60:
+        print("   ...Using cached query result")
+        return pd.read_parquet(pq_path)
+    
+    # Download through the BigQuery Storage Read API: columnar Arrow streams over gRPC,
+    # read in parallel, instead of paging JSON rows over REST
+    df = client.query(query).to_dataframe(create_bqstorage_client=True)
+    
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    df.to_parquet(pq_path)
+    return df
+
+def get_client():
     print("🔌 Connecting to BigQuery...")
     credentials = service_account.Credentials.from_service_account_file(KEY_PATH)
-    client = bigquery.Client(credentials=credentials, project=credentials.project_id)
-    
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+def get_data_and_format(client):
+    # The materialized view holds only the columns we need (the model sorts journeys itself)
     query = """
-    SELECT * FROM `attribution_dev.fct_attributed_conversions`
-    ORDER BY user_id, timestamp
+    SELECT user_id, timestamp, source, interaction, conversion_value
+    FROM `attribution_dev.mv_attributed_conversions`
     """
     
-    df = client.query(query).to_dataframe()
+    df = cached_query(client, query)
     
     print("🧹 Pre-processing data...")
     # Standardize column names
@@ -171,9 +193,27 @@ def get_data_and_format():
     df['conversion'] = df['interaction'] == 'conversion'
     df['conversion_value'] = df['conversion_value'].fillna(0)
     
+    # Compact dtypes: channel becomes integer category codes and user ids fit in int32,
+    # which keeps the model's groupbys on small arrays instead of Python strings
+    df['channel'] = df['channel'].astype('category')
+    df['cookie'] = df['cookie'].astype('int32')
+    
     return df
 
-def run_comparison(df):
+def get_last_click(client):
+    # Last Click (Simple Benchmark) is a plain GROUP BY on the conversion events,
+    # so let BigQuery aggregate it and only download one row per channel
+    query = """
+    SELECT channel, last_click_value
+    FROM `attribution_dev.mv_last_click`
+    """
+    
+    lc_df = cached_query(client, query)
+    lc_df.columns = ['Channel', 'Last Click Value']
+    
+    return lc_df
+
+def run_comparison(df, lc_df):
     print("🧮 Running Attribution Models...")
     
     # 1. Custom Markov Model
@@ -181,13 +221,10 @@ def run_comparison(df):
     model.fit()
     markov_df = model.calculate_attribution()
     
-    # 2. Last Click (Simple Benchmark)
-    print("   ...Calculating Last Click")
-    lc_df = df[df['conversion'] == True].groupby('channel')['conversion_value'].sum().reset_index()
-    lc_df.columns = ['Channel', 'Last Click Value']
-    
-    # 3. Merge
-    comparison = pd.merge(markov_df, lc_df, on='Channel', how='outer').fillna(0)
+    # 2. Merge with the Last Click benchmark (already aggregated in BigQuery)
+    # Index-aligned join on Channel (one hash lookup instead of a sort-merge)
+    comparison = markov_df.set_index('Channel').join(lc_df.set_index('Channel'), how='outer').fillna(0)
+    comparison = comparison.reset_index()
     return comparison
 
 def visualize(comparison_df):
@@ -214,6 +251,8 @@ def visualize(comparison_df):
     plt.show()
 
 if __name__ == "__main__":
-    df = get_data_and_format()
-    results = run_comparison(df)
+    client = get_client()
+    df = get_data_and_format(client)
+    lc_df = get_last_click(client)
+    results = run_comparison(df, lc_df)
     visualize(results)
\ No newline at end of file